@@ -1,33 +1,116 @@
 import sys
 import json
+import math
+from array import array
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import pandas as pd
 from fitparse import FitFile
-from datetime import timedelta
 import matplotlib.pyplot as plt
 import numpy as np
 import os # Importation nécessaire
 
-# La commande a lancer : python extract_fit_file.py "./uploads/fichier.fit" ./results/
+from fit_export_utils import (
+    compute_moving_time, downcast_record_dtypes, parse_output_format, write_output
+)
+
+# La commande a lancer : python extract_fit_file.py "./uploads/fichier.fit" ./results/ [--format csv|parquet]
 
 # Facteur de conversion de la vitesse: 1 m/s = 3.6 km/h
 MS_TO_KMH = 3.6
 
-# Seuil pour la détection des arrêts longs et immobiles
-PAUSE_TIME_THRESHOLD_S = 10.0
-PAUSE_DISTANCE_THRESHOLD_M = 1.0
-
 # Nouveaux seuils de vitesse pour la classification des laps
 INTENSITY_SPEED_THRESHOLD = 17.05
 RECOVERY_SPEED_THRESHOLD = 8.65
 
-def format_seconds_to_min_sec(seconds):
-    if pd.isna(seconds):
-        return None
-    total_seconds = int(seconds)
-    minutes = total_seconds // 60
-    seconds = total_seconds % 60
-    return f"{minutes:02d}:{seconds:02d}"
+# Types réduits des colonnes de records (entiers nullables pour les champs parfois absents).
+# La distance reste en float64 : le float32 perd le centimètre au-delà de 131 km
+RECORD_DTYPES = {
+    'heart_rate': 'Int16', 'cadence_step_per_min': 'Int16', 'temperature': 'Int8', 'altitude': 'Int16',
+    'speed_kmh': 'float32', 'elapsed_time_s': 'float32', 'moving_elapsed_time_s': 'float32'
+}
+
+# Précision des colonnes flottantes exportées, appliquée à l'écriture (CSV comme Parquet)
+OUTPUT_FLOAT_DECIMALS = {'speed_kmh': 2, 'elapsed_time_s': 1, 'moving_elapsed_time_s': 1, 'elapsed_time_in_lap_s': 1}
+
+# Colonnes de temps formaté (texte), omises en parquet par write_output
+FORMATTED_TIME_COLUMNS = ['elapsed_time_min_sec', 'lap_duration_min_sec', 'total_elapsed_time_min_sec']
+
+# Champs 'record' ignorés dès l'extraction (speed et cadence sont supprimés après conversion)
+RECORD_FIELDS_TO_SKIP = frozenset([
+    "activity_type", "enhanced_altitude", "enhanced_speed", "fractional_cadence", 
+    "unknown_87", "unknown_88", "unknown_90", "position_lat", "position_long"
+])
+
+# Codes de nature des laps utilisés par classify_lap_nature_codes, qui sont aussi
+# les codes de la colonne catégorielle 'lap_nature' (catégories LAP_NATURE_LABELS)
+LAP_NATURE_WARM_UP = 0
+LAP_NATURE_INTENSITY = 1
+LAP_NATURE_RECOVERY = 2
+LAP_NATURE_COOL_DOWN = 3
+LAP_NATURE_UNKNOWN = 4
+LAP_NATURE_LABELS = ['Warm-up', 'Intensity', 'Recovery', 'Cool-down', 'Unknown']
+
+def format_series_to_min_sec(seconds):
+    """Convertit une Series de secondes en format MM:SS (vectorisé, None si manquant)."""
+    seconds = pd.to_numeric(seconds, errors='coerce')
+    missing = seconds.isna()
+    total_seconds = seconds.fillna(0).astype(np.int64)
+    minutes = (total_seconds // 60).astype(str).str.zfill(2)
+    secs = (total_seconds % 60).astype(str).str.zfill(2)
+    return (minutes + ':' + secs).mask(missing, None)
+
+def build_object_column(values):
+    """
+    Construit la colonne d'un champ non numérique (None pour les valeurs manquantes) :
+    les dates donnent un array datetime64 (NaT), les autres un array object.
+    """
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, datetime) for value in present):
+        # Conversion directe des datetime fitparse (UTC naïf), sans inférence pandas
+        return np.array(values, dtype='datetime64[us]')
+        
+    column = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        column[i] = value
+    return column
+
+def unknown_lap_natures(n):
+    """Colonne catégorielle 'lap_nature' de longueur n, entièrement 'Unknown'."""
+    return pd.Categorical.from_codes(np.full(n, LAP_NATURE_UNKNOWN, dtype=np.int8), categories=LAP_NATURE_LABELS)
+
+def classify_lap_nature_codes(is_intensity, in_band, is_low_speed, first_intensity_idx, last_intensity_idx):
+    """
+    Classifie les laps en un passage séquentiel à partir des masques de vitesse
+    (Intensité, bande Recovery-Intensité, basse vitesse) et des positions du premier
+    et du dernier lap d'Intensité (au moins un lap d'Intensité est attendu).
+    Renvoie un code par lap, indice dans LAP_NATURE_LABELS. Boucle Python simple :
+    il n'y a que quelques dizaines de laps par activité.
+    """
+    n = is_intensity.shape[0]
+    natures = np.full(n, LAP_NATURE_UNKNOWN, dtype=np.int8)
+    
+    for i in range(n):
+        if is_intensity[i]:
+            # 1. Intensité : Vitesse > 17.05 km/h
+            natures[i] = LAP_NATURE_INTENSITY
+        elif i < first_intensity_idx:
+            # 2. Warm-up : laps AVANT le premier lap d'Intensité
+            if in_band[i]:
+                natures[i] = LAP_NATURE_WARM_UP
+        elif i > last_intensity_idx:
+            # 3. Cool-down : laps APRÈS le dernier lap d'Intensité,
+            # sauf un lap lent qui suit directement un lap d'Intensité (Recovery)
+            if in_band[i]:
+                natures[i] = LAP_NATURE_COOL_DOWN
+            elif is_low_speed[i] and is_intensity[i - 1]:
+                natures[i] = LAP_NATURE_RECOVERY
+        else:
+            # 4. Recovery : tous les autres laps entre les bornes du bloc de travail
+            natures[i] = LAP_NATURE_RECOVERY
+            
+    return natures
 
 def classify_lap_nature_by_speed(df_laps):
     """
@@ -37,130 +120,140 @@ def classify_lap_nature_by_speed(df_laps):
     
     if df_laps.empty or 'avg_speed_kmh' not in df_laps.columns:
         if 'lap_nature' not in df_laps.columns:
-            df_laps['lap_nature'] = 'Unknown'
+            df_laps['lap_nature'] = unknown_lap_natures(len(df_laps))
         return df_laps
         
-    df_laps['lap_nature'] = 'Unknown'
+    # Masques de vitesse calculés une seule fois sur le tableau numpy brut
+    speeds = df_laps['avg_speed_kmh'].to_numpy(dtype=np.float64)
+    is_intensity = speeds > INTENSITY_SPEED_THRESHOLD
+    in_band = (speeds >= RECOVERY_SPEED_THRESHOLD) & (speeds <= INTENSITY_SPEED_THRESHOLD)
+    is_low_speed = speeds < RECOVERY_SPEED_THRESHOLD
     
-    # 1. Intensité : Vitesse > 17.05 km/h
-    mask_intensity = (df_laps['avg_speed_kmh'] > INTENSITY_SPEED_THRESHOLD)
-    df_laps.loc[mask_intensity, 'lap_nature'] = 'Intensity'
-
-    # Identifier les bornes (index) des laps d'Intensité
-    intensity_laps = df_laps[df_laps['lap_nature'] == 'Intensity']
-    
-    if not intensity_laps.empty:
-        first_intensity_idx = intensity_laps.index.min()
-        last_intensity_idx = intensity_laps.index.max()
-        
-        # 2. Warm-up : Tous les laps AVANT le premier lap d'Intensité
-        mask_warm_up = (df_laps.index < first_intensity_idx) & \
-                       (df_laps['avg_speed_kmh'].between(RECOVERY_SPEED_THRESHOLD, INTENSITY_SPEED_THRESHOLD, inclusive='both'))
-        df_laps.loc[mask_warm_up, 'lap_nature'] = 'Warm-up'
-        
-        # 3. Cool-down : Tous les laps APRÈS le dernier lap d'Intensité
-        mask_cool_down = (df_laps.index > last_intensity_idx) & \
-                         (df_laps['avg_speed_kmh'].between(RECOVERY_SPEED_THRESHOLD, INTENSITY_SPEED_THRESHOLD, inclusive='both'))
-        df_laps.loc[mask_cool_down, 'lap_nature'] = 'Cool-down'
-        
-        # 4. Recovery : Basse vitesse (< 8.65) ET suit un lap d'Intensité (logique séquentielle)
-        
-        # Colonne temporaire pour la nature du lap précédent
-        df_laps['prev_lap_nature'] = df_laps['lap_nature'].shift(1)
-        
-        mask_low_speed = (df_laps['avg_speed_kmh'] < RECOVERY_SPEED_THRESHOLD)
-        
-        # Un lap de Recovery doit être lent ET suivre un lap classé Intensity
-        # On inclut ici les laps de Recovery qui n'ont pas encore été classifiés
-        mask_recovery = mask_low_speed & (df_laps['prev_lap_nature'] == 'Intensity')
-        df_laps.loc[mask_recovery, 'lap_nature'] = 'Recovery'
-        
-        # 5. Classer le reste entre les bornes (les laps 'Unknown' restants dans le bloc de travail)
-        mask_remaining_unknown = (df_laps.index >= first_intensity_idx) & \
-                                 (df_laps.index <= last_intensity_idx) & \
-                                 (df_laps['lap_nature'] == 'Unknown')
-                                 
-        df_laps.loc[mask_remaining_unknown, 'lap_nature'] = 'Recovery'
-
-        df_laps = df_laps.drop(columns=['prev_lap_nature'], errors='ignore')
-
+    # Identifier les bornes (positions) des laps d'Intensité
+    intensity_idx = np.flatnonzero(is_intensity)
+    if intensity_idx.size:
+        natures = classify_lap_nature_codes(
+            is_intensity, in_band, is_low_speed, intensity_idx[0], intensity_idx[-1]
+        )
     else:
-        # S'il n'y a pas de lap d'Intensité détecté
-        df_laps.loc[df_laps['lap_nature'] == 'Unknown', 'lap_nature'] = 'Warm-up'
+        # S'il n'y a pas de lap d'Intensité détecté, tous les laps sont des Warm-up
+        natures = np.full(len(speeds), LAP_NATURE_WARM_UP, dtype=np.int8)
+    df_laps['lap_nature'] = pd.Categorical.from_codes(natures, categories=LAP_NATURE_LABELS)
         
     return df_laps
 
-def parse_fit(ff):
+def parse_fit(ff, laps):
+    """
+    Extrait et traite les records. Renvoie (df des records, df_lap_summary classifié ou None),
+    le résumé des laps étant réutilisé pour l'export par lap.
+    """
     # 1. Extraction des enregistrements de la session (Record Messages)
-    rows = []
-    columns_to_drop = [
-        "activity_type", "enhanced_altitude", "enhanced_speed", "fractional_cadence", 
-        "unknown_87", "unknown_88", "unknown_90", "speed", "cadence", "position_lat", "position_long"
-    ]
+    
+    # Accumulation colonne par colonne (le schéma est découvert au fil de l'eau) : un array
+    # typé (float64) par champ numérique, complété par NaN pour chaque record où le champ est
+    # absent ; seuls les champs non numériques (dates, textes...) passent par une liste d'objets
+    numeric_columns = {}
+    object_columns = {}
+    float_fields = set()
+    n_records = 0
     
     for rec in ff.get_messages('record'):
-        r = {}
+        for col in numeric_columns.values():
+            col.append(math.nan)
+        for col in object_columns.values():
+            col.append(None)
         for field in rec:
-            r[field.name] = field.value
-        rows.append(r) 
+            name = field.name
+            if name in RECORD_FIELDS_TO_SKIP:
+                continue
+            value = field.value
+            col = numeric_columns.get(name)
+            if col is None and name not in object_columns:
+                # Nouveau champ : NaN pour tous les records précédents
+                col = numeric_columns[name] = array('d', [math.nan]) * (n_records + 1)
+            if col is not None:
+                if value is None:
+                    continue
+                if type(value) is int:
+                    col[-1] = value
+                    continue
+                if type(value) is float:
+                    col[-1] = value
+                    float_fields.add(name)
+                    continue
+                # Valeur non numérique : le champ bascule dans une colonne d'objets
+                is_float = name in float_fields
+                object_columns[name] = [None if math.isnan(v) else v if is_float else int(v) for v in col]
+                del numeric_columns[name]
+            object_columns[name][-1] = value
+        n_records += 1
         
-    if not rows:
+    if not n_records:
         raise RuntimeError("Aucun record trouvé dans le fichier .fit")
     
-    df = pd.DataFrame(rows)
+    columns = {}
+    for name, col in numeric_columns.items():
+        values = np.frombuffer(col, dtype=np.float64)
+        # Champ entier renseigné sur tous les records : conservé en int64
+        if name not in float_fields and not np.isnan(values).any():
+            values = values.astype(np.int64)
+        columns[name] = values
+    for name, values in object_columns.items():
+        columns[name] = build_object_column(values)
+    df = pd.DataFrame(columns, index=pd.RangeIndex(n_records))
     
     # 2. Nettoyage et normalisation des données
     if 'timestamp' in df.columns:
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df = df.sort_values('timestamp').reset_index(drop=True)
-        df['elapsed_time_s'] = (df['timestamp'] - df['timestamp'].iloc[0]).dt.total_seconds()
+        # Les timestamps sont déjà en datetime64 : tri uniquement s'ils ne sont pas ordonnés
+        timestamps = df['timestamp'].to_numpy()
+        if not df['timestamp'].is_monotonic_increasing:
+            order = np.argsort(timestamps, kind='stable')
+            df = df.iloc[order].reset_index(drop=True)
+            timestamps = timestamps[order]
+        df['elapsed_time_s'] = (timestamps - timestamps[0]) / np.timedelta64(1, 's')
     
     # 3. Conversion de la vitesse m/s -> km/h
     if 'speed' in df.columns:
-        df['speed_kmh'] = np.round(df['speed'] * MS_TO_KMH, 2)
+        df['speed_kmh'] = df['speed'] * MS_TO_KMH
+        df = df.drop(columns=['speed'])
         
     # 4. Traitements sur les colonnes existantes
     if 'cadence' in df.columns:
         df['cadence_step_per_min'] = df['cadence'] * 2
+        df = df.drop(columns=['cadence'])
 
     for col in ['stance_time', 'step_length', 'altitude']:
         if col in df.columns:
             df[col] = np.round(df[col]).astype('Int64')
 
+    # 4.B Réduction des types avant les traitements par lap (colonnes plus étroites)
+    df = downcast_record_dtypes(df, RECORD_DTYPES)
+
     # 5. Ajout de l'information des laps
-    df = add_lap_info(ff, df) # Appel à la fonction modifiée
+    df, df_lap_summary = add_lap_info(laps, df) # Appel à la fonction modifiée
     
     # 6. Ajout du temps écoulé dans le lap en cours (elapsed_time_in_lap_s)
     if 'lap_number' in df.columns and 'elapsed_time_s' in df.columns:
-        lap_start_time = df.groupby('lap_number')['elapsed_time_s'].transform('min')
-        df['elapsed_time_in_lap_s'] = df['elapsed_time_s'] - lap_start_time
-        df['elapsed_time_in_lap_s'] = np.round(df['elapsed_time_in_lap_s'], 1)
+        # lap_number est croissant (records triés) : le début de chaque lap est
+        # l'elapsed_time_s du premier record où lap_number change
+        lap_numbers = df['lap_number'].to_numpy()
+        elapsed_time_s = df['elapsed_time_s'].to_numpy()
+        lap_first_idx = np.flatnonzero(np.diff(lap_numbers, prepend=lap_numbers[0] - 1))
+        lap_idx = np.searchsorted(lap_numbers[lap_first_idx], lap_numbers)
+        df['elapsed_time_in_lap_s'] = elapsed_time_s - elapsed_time_s[lap_first_idx][lap_idx]
 
     # 7. Ajout des colonnes demandées (Moving Time)
     if 'elapsed_time_s' in df.columns and 'distance' in df.columns:
-        df['dt'] = df['elapsed_time_s'].diff()
-        df['dd'] = df['distance'].diff().fillna(0)
-        
-        is_break_real = (df['dt'] >= PAUSE_TIME_THRESHOLD_S) & (df['dd'] <= PAUSE_DISTANCE_THRESHOLD_M)
-        
-        df['pause_correction_s'] = np.where(is_break_real, df['dt'] - 1.0, 0.0)
-        df.loc[0, 'pause_correction_s'] = 0.0
-        
-        df['cumulative_pause_s'] = df['pause_correction_s'].cumsum()
-        
-        df['moving_elapsed_time_s'] = df['elapsed_time_s'] - df['cumulative_pause_s']
-        df['moving_elapsed_time_s'] = np.round(df['moving_elapsed_time_s'], 1)
-        
-        df = df.drop(columns=['dt', 'dd', 'pause_correction_s', 'cumulative_pause_s'], errors='ignore')
+        df['moving_elapsed_time_s'] = compute_moving_time(
+            df['elapsed_time_s'].to_numpy(dtype=np.float64),
+            df['distance'].to_numpy(dtype=np.float64)
+        ).astype(RECORD_DTYPES['moving_elapsed_time_s'])
 
     # 7.B Colonne de temps formaté (MM:SS)
     if 'elapsed_time_s' in df.columns:
-        df['elapsed_time_min_sec'] = df['moving_elapsed_time_s'].apply(format_seconds_to_min_sec)
+        df['elapsed_time_min_sec'] = format_series_to_min_sec(df['moving_elapsed_time_s'].round(1))
 
-    # 8. Suppression des colonnes indésirables
-    df = df.drop(columns=columns_to_drop, errors='ignore')
-    
-    # 9. Réorganisation des colonnes principales
+    # 8. Réorganisation des colonnes principales
     col_order_priority = [
         'timestamp', 'elapsed_time_s', 'moving_elapsed_time_s', 'elapsed_time_min_sec',
         'lap_number', 'lap_nature', 'elapsed_time_in_lap_s', 'distance', 'speed_kmh', 
@@ -174,33 +267,40 @@ def parse_fit(ff):
     
     df = df.reindex(columns=new_column_order)
     
-    return df
+    return df, df_lap_summary
 
-def add_lap_info(fitfile, df):
+def extract_laps(fitfile):
     """
-    Ajoute le numéro de lap et la nature du lap (classée par vitesse) 
-    à chaque timestamp du dataframe de records.
+    Décode une seule fois les messages 'lap' du fichier FIT en une liste de dictionnaires,
+    partagée ensuite par add_lap_info et build_lap_dataframe.
     """
-    
-    if df.empty or 'timestamp' not in df.columns:
-        print("DataFrame ou colonne 'timestamp' manquante pour l'ajout des laps.")
-        df['lap_number'] = 1 
-        df['lap_nature'] = 'Unknown'
-        return df
-    
-    # 1. Extraction et assignation du lap_number
     laps = []
     for lap in fitfile.get_messages('lap'):
         lap_data = {}
         for field in lap:
             lap_data[field.name] = field.value
         laps.append(lap_data)
+    return laps
+
+def add_lap_info(laps, df):
+    """
+    Ajoute le numéro de lap et la nature du lap (classée par vitesse) 
+    à chaque timestamp du dataframe de records.
+    Renvoie (df, df_lap_summary), df_lap_summary valant None si aucun lap n'est exploitable.
+    """
+    
+    if df.empty or 'timestamp' not in df.columns:
+        print("DataFrame ou colonne 'timestamp' manquante pour l'ajout des laps.")
+        df['lap_number'] = 1 
+        df['lap_nature'] = unknown_lap_natures(len(df))
+        return df, None
     
+    # 1. Assignation du lap_number
     if not laps:
         print("Aucun lap trouvé. Tous les enregistrements sont assignés au lap 1.")
         df['lap_number'] = 1
-        df['lap_nature'] = 'Unknown'
-        return df
+        df['lap_nature'] = unknown_lap_natures(len(df))
+        return df, None
 
     laps_sorted = sorted([lap for lap in laps if 'start_time' in lap and lap['start_time']], 
                          key=lambda x: x['start_time'])
@@ -208,31 +308,28 @@ def add_lap_info(fitfile, df):
     if not laps_sorted:
         print("Laps trouvés mais sans 'start_time'. Tous les enregistrements sont assignés au lap 1.")
         df['lap_number'] = 1
-        df['lap_nature'] = 'Unknown'
-        return df
-
-    df['lap_number'] = 0
-    
-    # Assigner lap_number au DF de records ET ajouter le lap_number au dictionnaire lap pour la classification
-    for lap_num, lap in enumerate(laps_sorted, 1):
-        lap['lap_number'] = lap_num  # Assigner le numéro au lap pour la création du DF de résumé
-        lap_start = pd.to_datetime(lap['start_time'])
-        
-        if lap_num < len(laps_sorted):
-            next_lap_start = pd.to_datetime(laps_sorted[lap_num]['start_time'])
-        else:
-            next_lap_start = df['timestamp'].max() + timedelta(seconds=1)
-        
-        mask = (df['timestamp'] >= lap_start) & (df['timestamp'] < next_lap_start)
-        df.loc[mask, 'lap_number'] = lap_num
-        
-    df.loc[df['lap_number'] == 0, 'lap_number'] = len(laps_sorted)
+        df['lap_nature'] = unknown_lap_natures(len(df))
+        return df, None
+
+    # Ajouter le lap_number à une copie du dictionnaire lap pour la création du DF de résumé
+    # (la liste des laps ne doit pas être modifiée)
+    laps_sorted = [{**lap, 'lap_number': lap_num} for lap_num, lap in enumerate(laps_sorted, 1)]
+
+    # Assigner lap_number au DF de records en une seule recherche dichotomique
+    # (les timestamps et les débuts de laps sont triés)
+    # Les débuts de laps sont convertis en bloc dans l'unité des timestamps (pas de copie des records)
+    timestamps = df['timestamp'].to_numpy()
+    lap_starts = np.array([lap['start_time'] for lap in laps_sorted], dtype=timestamps.dtype)
+    df['lap_number'] = np.searchsorted(lap_starts, timestamps, side='right').clip(1, len(laps_sorted))
     # print(f"{len(laps_sorted)} laps détectés et assignés aux enregistrements") # Commenté pour éviter la sortie console
     
     # 2. Classification de la nature du lap basée sur la vitesse (avg_speed_kmh)
     
     # Création du DataFrame de résumé des laps à partir des messages 'lap'
     df_lap_summary = pd.DataFrame(laps_sorted)
+    
+    # Nature de chaque lap, indexée par lap_number - 1 ('Unknown' si non classifiable)
+    lap_natures = unknown_lap_natures(len(laps_sorted))
 
     if 'avg_speed' in df_lap_summary.columns and 'lap_number' in df_lap_summary.columns:
         
@@ -242,59 +339,52 @@ def add_lap_info(fitfile, df):
         
         # 2.B. Classer les laps
         df_lap_summary = classify_lap_nature_by_speed(df_lap_summary)
+        # df_lap_summary est construit à partir de laps_sorted : déjà ordonné par lap_number
+        lap_natures = df_lap_summary['lap_nature'].array
+    # else: 'avg_speed' non trouvé dans les messages 'lap', classification de 'lap_nature' impossible
         
-        # 2.C. Fusionner la nature du lap (lap_nature) dans le DF des records (df)
-        df_nature = df_lap_summary[['lap_number', 'lap_nature']].copy()
+    # 2.C. Reporter la nature du lap dans le DF des records (lap_number est dense dans [1, L])
+    # Colonne catégorielle : seuls les codes (1 octet par record) sont recopiés
+    df['lap_nature'] = pd.Categorical.from_codes(lap_natures.codes[df['lap_number'].to_numpy() - 1], dtype=lap_natures.dtype)
         
-        df = df.drop(columns=['lap_nature'], errors='ignore') 
-        df = df.merge(df_nature, on='lap_number', how='left')
-        
-        df['lap_nature'] = df['lap_nature'].fillna('Unknown')
-    else:
-        # print("Avertissement: 'avg_speed' non trouvé dans les messages 'lap'. Classification de 'lap_nature' impossible.") # Commenté
-        df['lap_nature'] = 'Unknown'
-        
-    return df
+    return df, df_lap_summary
 
-def export_lap_csv(fitfile, output_path):
+def build_lap_dataframe(laps, df_lap_summary=None):
     """
-    Extrait toutes les données des messages 'lap', ajoute les colonnes de lisibilité
-    et les exporte dans le fichier activity_data_by_lap.csv.
+    À partir des messages 'lap' déjà extraits, construit le DF par lap avec les colonnes
+    de lisibilité (contenu du fichier activity_data_by_lap.csv). L'écriture est faite par main.
+    Le résumé déjà classifié par add_lap_info est réutilisé s'il couvre tous les laps ;
+    sinon le DF est construit et classifié à partir de la liste brute.
     """
-    laps = []
-    
     columns_to_drop = [
         "avg_cadence_position", "avg_combined_pedal_smoothness", "avg_fractional_cadence", "avg_left_pco", "avg_left_pedal_smoothness", "enhanced_avg_speed", "enhanced_max_speed", "total_ascent", "avg_left_power_phase", "avg_left_power_phase_peak", "avg_left_torque_effectiveness", "avg_power", "avg_power_position", "avg_right_pco", "avg_right_pedal_smoothness", "avg_right_power_phase", "avg_right_power_phase_peak", "avg_right_torque_effectiveness", "avg_stroke_distance", "end_position_lat", "end_position_long", "event_group", "event", "event_type", "first_length_index", "intensity", "lap_trigger", "left_right_balance", "max_cadence_position", "max_fractional_cadence", "max_power", "max_power_position", "max_running_cadence", "max_temperature", "message_index", "normalized_power", "num_active_lengths", "num_lengths", "sport", "stand_count", "start_position_lat", "start_position_long", "sub_sport", "swim_stroke", "time_standing", "total_calories", "total_descent", "total_fat_calories", "total_fractional_cycles", "total_work", "wkt_step_index", "unknown_124", "unknown_125", "unknown_126", "unknown_27", "unknown_28", "unknown_29", "unknown_30", "unknown_70", "unknown_72", "unknown_73", "unknown_90", "unknown_96", "unknown_97", "avg_speed", "max_speed", "start_time", "lap_duration_min_sec", "timestamp", "total_elapsed_time_min_sec"
         ]
 
-    # Parcourir les messages 'lap'
-    for lap_num, lap in enumerate(fitfile.get_messages('lap'), 1):
-        lap_data = {"lap_number": lap_num}
-        for field in lap:
-            lap_data[field.name] = field.value
-        laps.append(lap_data)
-
     if not laps:
         # print("Avertissement: Aucun lap trouvé pour l'exportation par lap.") # Commenté
         return None
 
-    df_laps = pd.DataFrame(laps)
+    if df_lap_summary is not None and len(df_lap_summary) == len(laps):
+        df_laps = df_lap_summary.copy()
+    else:
+        # Pas de résumé (records sans timestamp) ou laps sans 'start_time' exclus du résumé
+        df_laps = pd.DataFrame([{"lap_number": lap_num, **lap} for lap_num, lap in enumerate(laps, 1)])
     
     if 'total_timer_time' in df_laps.columns:
         df_laps = df_laps.rename(columns={"total_timer_time": "lap_duration"})
 
-    # Conversion des vitesses en km/h
+    # Conversion des vitesses en km/h (avg_speed_kmh est déjà calculée si le résumé est réutilisé)
     for speed_col in ['max_speed', 'avg_speed']:
-        if speed_col in df_laps.columns:
+        if speed_col in df_laps.columns and f'{speed_col}_kmh' not in df_laps.columns:
             df_laps[speed_col] = pd.to_numeric(df_laps[speed_col], errors='coerce') 
             df_laps[f'{speed_col}_kmh'] = np.round(df_laps[speed_col] * MS_TO_KMH, 2)
 
-    # Classification par vitesse sur le DF de laps
-    if 'avg_speed_kmh' in df_laps.columns:
+    # Classification par vitesse sur le DF de laps, si elle n'a pas déjà été faite par add_lap_info
+    if 'avg_speed_kmh' in df_laps.columns and 'lap_nature' not in df_laps.columns:
         # Assurer le tri pour la logique séquentielle
         df_laps = df_laps.sort_values('lap_number').reset_index(drop=True) 
-        df_laps = classify_lap_nature_by_speed(df_laps) # Utilise la nouvelle fonction
-        
+        df_laps = classify_lap_nature_by_speed(df_laps)
+
     # Conversion du cycle de la cadence en ppm
     if 'avg_running_cadence' in df_laps.columns:
         df_laps['avg_running_cadence_step_per_min'] = df_laps['avg_running_cadence'] * 2
@@ -306,7 +396,7 @@ def export_lap_csv(fitfile, output_path):
     # Ajout des colonnes de temps formaté (MM:SS)
     for time_col in ['lap_duration', 'total_elapsed_time']:
         if time_col in df_laps.columns:
-            df_laps[f'{time_col}_min_sec'] = df_laps[time_col].apply(format_seconds_to_min_sec)
+            df_laps[f'{time_col}_min_sec'] = format_series_to_min_sec(df_laps[time_col])
 
     # Réorganisation des colonnes principales
     col_order_priority = [
@@ -334,49 +424,62 @@ def export_lap_csv(fitfile, output_path):
     new_column_order = existing_priority_cols + sorted(remaining_cols)
     
     df_laps = df_laps.reindex(columns=new_column_order)
-
-    # Export CSV
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    df_laps.to_csv(output_path, index=False)
     return df_laps
 
 def main():
     # Deux arguments sont maintenant attendus : le chemin du fichier FIT et le chemin du dossier de sortie
-    if len(sys.argv) < 3:
+    # (plus l'option --format csv|parquet)
+    args, output_format = parse_output_format(sys.argv[1:])
+    if len(args) < 2 or output_format is None:
         # Renvoie un message JSON pour que Node.js puisse le lire
-        error_msg = {"status": "error", "message": "Usage: python extract_fit.py path/to/file.fit path/to/output_dir/"}
+        error_msg = {"status": "error", "message": "Usage: python extract_fit.py path/to/file.fit path/to/output_dir/ [--format csv|parquet]"}
         print(json.dumps(error_msg))
         sys.exit(1)
     
-    fit_file_path = Path(sys.argv[1])
-    output_dir = Path(sys.argv[2])
+    fit_file_path = Path(args[0])
+    output_dir = Path(args[1])
     
     # Création de noms de fichiers uniques (basés sur le nom du fichier FIT, sans l'extension)
     file_stem = fit_file_path.stem 
-    output_path_records_csv = output_dir / f"{file_stem}_records.csv"
-    output_path_laps_csv = output_dir / f"{file_stem}_laps.csv"
+    output_path_records = output_dir / f"{file_stem}_records.{output_format}"
+    output_path_laps = output_dir / f"{file_stem}_laps.{output_format}"
 
     try:
         ff = FitFile(str(fit_file_path))
         
+        # Les messages 'lap' sont décodés une seule fois pour les records et les laps
+        laps = extract_laps(ff)
+        
         # 1. Traitement et export du fichier de RECORDS 
-        df = parse_fit(ff)
+        df, df_lap_summary = parse_fit(ff, laps)
 
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        # Export CSV des records
-        df.to_csv(output_path_records_csv, index=False)
-        
-        # 2. Traitement et export du fichier de LAPS
-        export_lap_csv(ff, output_path_laps_csv)
+        # Les deux exports sont indépendants : l'écriture des records (CSV ou Parquet)
+        # se fait en parallèle du traitement puis de l'écriture des laps
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            records_future = executor.submit(
+                write_output, df, output_path_records, output_format, OUTPUT_FLOAT_DECIMALS, FORMATTED_TIME_COLUMNS
+            )
+            
+            # 2. Traitement et export du fichier de LAPS
+            df_laps = build_lap_dataframe(laps, df_lap_summary)
+            if df_laps is not None:
+                executor.submit(
+                    write_output, df_laps, output_path_laps, output_format, OUTPUT_FLOAT_DECIMALS, FORMATTED_TIME_COLUMNS
+                ).result()
+            records_future.result()
 
         # 3. Renvoyer les chemins des fichiers en JSON pour Node.js
         result = {
             "status": "success",
-            "message": "Fichiers CSV générés avec succès.",
-            "records_csv_path": str(output_path_records_csv),
-            "laps_csv_path": str(output_path_laps_csv)
+            "message": f"Fichiers {output_format.upper()} générés avec succès.",
+            "output_format": output_format,
+            f"records_{output_format}_path": str(output_path_records)
         }
+        # Le chemin des laps n'est renvoyé que si le fichier a bien été écrit
+        if df_laps is not None:
+            result[f"laps_{output_format}_path"] = str(output_path_laps)
         print(json.dumps(result))
 
     except FileNotFoundError:
@@ -1,18 +1,39 @@
 import sys
 import json
+import math
+from array import array
 from pathlib import Path
 import pandas as pd
 from fitparse import FitFile
 import numpy as np
 from datetime import datetime, timedelta
 
+from fit_export_utils import (
+    compute_moving_time, downcast_record_dtypes, parse_output_format, write_output
+)
+
 # --- Constantes ---
 MS_TO_KMH = 3.6 
 CADENCE_TO_SPM = 2 # 1 cycle (rpm) = 2 pas (spm)
 
-# Seuil pour la détection des arrêts longs et immobiles pour le calcul du Moving Time
-PAUSE_TIME_THRESHOLD_S = 10.0
-PAUSE_DISTANCE_THRESHOLD_M = 1.0
+# Champs 'record' d'intérêt prioritaires (les autres sont ignorés dès l'extraction)
+RECORD_FIELDS_OF_INTEREST = (
+    "timestamp", "heart_rate", "enhanced_speed", "distance", 
+    "cadence", "power", "enhanced_altitude"
+)
+
+# Types réduits des colonnes de records (entiers nullables pour les champs parfois absents).
+# La distance reste en float64 : le float32 perd le centimètre au-delà de 131 km
+RECORD_DTYPES = {
+    'heart_rate': 'Int16', 'cadence_step_per_min': 'Int16', 'power': 'Int16', 'enhanced_altitude': 'float32',
+    'speed_kmh': 'float32', 'elapsed_time_s': 'float32', 'moving_elapsed_time_s': 'float32'
+}
+
+# Précision des colonnes flottantes exportées, appliquée à l'écriture (CSV comme Parquet)
+OUTPUT_FLOAT_DECIMALS = {'speed_kmh': 2, 'elapsed_time_s': 1, 'moving_elapsed_time_s': 1}
+
+# Colonnes de temps formaté (texte), omises en parquet par write_output
+FORMATTED_TIME_COLUMNS = ['elapsed_time_hms']
 
 # --- Fonctions utilitaires ---
 
@@ -29,6 +50,19 @@ def format_seconds_to_hms(seconds):
         return f"{hours}:{minutes:02d}:{secs:02d}"
     return f"{minutes:02d}:{secs:02d}"
 
+def format_series_to_hms(seconds):
+    """Version vectorisée de format_seconds_to_hms pour une Series de secondes."""
+    seconds = pd.to_numeric(seconds, errors='coerce')
+    missing = seconds.isna()
+    total_seconds = seconds.fillna(0).astype(np.int64)
+    hours = total_seconds // 3600
+    minutes = ((total_seconds % 3600) // 60).astype(str).str.zfill(2)
+    secs = (total_seconds % 60).astype(str).str.zfill(2)
+    
+    min_sec = minutes + ':' + secs
+    hms = hours.astype(str) + ':' + min_sec
+    return hms.where(hours > 0, min_sec).mask(missing, None)
+
 # --- Fonctions principales d'extraction et de traitement ---
 
 def parse_fit_records(fitfile):
@@ -36,37 +70,52 @@ def parse_fit_records(fitfile):
     Extrait et traite les messages 'record' du fichier FIT.
     Calcule l'elapsed time, le moving time, et convertit les unités.
     """
-    rows = []
-    # Champs d'intérêt prioritaires
-    record_fields_of_interest = [
-        "timestamp", "heart_rate", "enhanced_speed", "distance", 
-        "cadence", "power", "enhanced_altitude"
-    ]
+    # Accumulation colonne par colonne : un array typé (float64) par champ numérique,
+    # complété par NaN pour chaque record où le champ est absent
+    columns = {name: array('d') for name in RECORD_FIELDS_OF_INTEREST if name != 'timestamp'}
+    timestamps = []
+    seen_fields = set()
     
     for rec in fitfile.get_messages('record'):
-        r = {}
+        timestamps.append(None)
+        for col in columns.values():
+            col.append(math.nan)
         for field in rec:
-            if field.name in record_fields_of_interest:
-                r[field.name] = field.value
-        rows.append(r) 
+            if field.name == 'timestamp':
+                timestamps[-1] = field.value
+            elif field.name in columns:
+                if field.value is not None:
+                    columns[field.name][-1] = field.value
+            else:
+                continue
+            seen_fields.add(field.name)
         
-    if not rows:
+    if not timestamps:
         raise RuntimeError("Aucun record trouvé dans le fichier .fit")
     
-    df = pd.DataFrame(rows)
+    df = pd.DataFrame({
+        name: np.frombuffer(col, dtype=np.float64)
+        for name, col in columns.items() if name in seen_fields
+    }, index=pd.RangeIndex(len(timestamps)))
+    if 'timestamp' in seen_fields:
+        # Conversion directe des datetime fitparse (UTC naïf) en datetime64, sans inférence pandas
+        df.insert(0, 'timestamp', np.array(timestamps, dtype='datetime64[us]'))
     
     # 1. Nettoyage et normalisation des données
     if 'timestamp' in df.columns:
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-        df = df.sort_values('timestamp').reset_index(drop=True)
+        # Les timestamps sont déjà en datetime64 : tri uniquement s'ils ne sont pas ordonnés
+        timestamps = df['timestamp'].to_numpy()
+        if not df['timestamp'].is_monotonic_increasing:
+            order = np.argsort(timestamps, kind='stable')
+            df = df.iloc[order].reset_index(drop=True)
+            timestamps = timestamps[order]
         # Calcul du temps écoulé total
-        df['elapsed_time_s'] = (df['timestamp'] - df['timestamp'].iloc[0]).dt.total_seconds()
-        df['elapsed_time_s'] = np.round(df['elapsed_time_s'], 1)
+        df['elapsed_time_s'] = (timestamps - timestamps[0]) / np.timedelta64(1, 's')
 
     # 2. Conversion de la vitesse m/s -> km/h
     if 'enhanced_speed' in df.columns:
         df = df.rename(columns={'enhanced_speed': 'speed_ms'})
-        df['speed_kmh'] = np.round(df['speed_ms'] * MS_TO_KMH, 2)
+        df['speed_kmh'] = df['speed_ms'] * MS_TO_KMH
         df = df.drop(columns=['speed_ms'], errors='ignore')
 
     # 3. Conversion de la cadence cycle/min -> pas/min (spm)
@@ -76,33 +125,22 @@ def parse_fit_records(fitfile):
         # ou en pas/minute pour la course à pied. Pour la course, 1 cycle = 2 pas.
         # On assume l'approche générique pour la course :
         df['cadence_step_per_min'] = df['cadence_rpm'] * CADENCE_TO_SPM
-        df['cadence_step_per_min'] = df['cadence_step_per_min'].astype('Int64', errors='ignore')
         df = df.drop(columns=['cadence_rpm'], errors='ignore')
         
+    # 3.B Réduction des types (cadence en Int16, vitesse et temps en float32...)
+    df = downcast_record_dtypes(df, RECORD_DTYPES)
+        
     # 4. Traitement du Moving Time (Temps en mouvement)
     if 'elapsed_time_s' in df.columns and 'distance' in df.columns:
-        # Calcul de la différence de temps (dt) et de distance (dd) entre les points
-        df['dt'] = df['elapsed_time_s'].diff()
-        df['dd'] = df['distance'].diff().fillna(0)
-        
-        # Détection des pauses: grand dt ET petit dd
-        is_real_pause = (df['dt'] >= PAUSE_TIME_THRESHOLD_S) & (df['dd'] <= PAUSE_DISTANCE_THRESHOLD_M)
-        
-        # La correction est le temps de pause (dt - 1 seconde pour compter l'arrêt)
-        df['pause_correction_s'] = np.where(is_real_pause, df['dt'] - 1.0, 0.0)
-        df.loc[0, 'pause_correction_s'] = 0.0 # Pas de correction pour le premier point
-        
-        df['cumulative_pause_s'] = df['pause_correction_s'].cumsum()
-        
         # Temps en mouvement = Temps total - Temps de pause cumulé
-        df['moving_elapsed_time_s'] = df['elapsed_time_s'] - df['cumulative_pause_s']
-        df['moving_elapsed_time_s'] = np.round(df['moving_elapsed_time_s'], 1)
-        
-        df = df.drop(columns=['dt', 'dd', 'pause_correction_s', 'cumulative_pause_s'], errors='ignore')
+        df['moving_elapsed_time_s'] = compute_moving_time(
+            df['elapsed_time_s'].to_numpy(dtype=np.float64),
+            df['distance'].to_numpy(dtype=np.float64)
+        ).astype(RECORD_DTYPES['moving_elapsed_time_s'])
 
     # 5. Colonne de temps formaté (H:MM:SS ou MM:SS)
     if 'moving_elapsed_time_s' in df.columns:
-        df['elapsed_time_hms'] = df['moving_elapsed_time_s'].apply(format_seconds_to_hms)
+        df['elapsed_time_hms'] = format_series_to_hms(df['moving_elapsed_time_s'].round(1))
     
     # 6. Renommage et réorganisation
     if 'enhanced_altitude' in df.columns:
@@ -176,16 +214,17 @@ def extract_activity_summary(fitfile):
 
 def main():
     """Fonction principale pour l'exécution du script."""
-    if len(sys.argv) < 3:
-        error_msg = {"status": "error", "message": "Usage: python extract_fit.py path/to/file.fit path/to/output_dir/"}
+    args, output_format = parse_output_format(sys.argv[1:])
+    if len(args) < 2 or output_format is None:
+        error_msg = {"status": "error", "message": "Usage: python extract_fit.py path/to/file.fit path/to/output_dir/ [--format csv|parquet]"}
         print(json.dumps(error_msg))
         sys.exit(1)
     
-    fit_file_path = Path(sys.argv[1])
-    output_dir = Path(sys.argv[2])
+    fit_file_path = Path(args[0])
+    output_dir = Path(args[1])
     
     file_stem = fit_file_path.stem 
-    output_path_records_csv = output_dir / f"{file_stem}_records.csv"
+    output_path_records = output_dir / f"{file_stem}_records.{output_format}"
     output_path_summary_json = output_dir / f"{file_stem}_activity_summary.json"
 
     try:
@@ -196,7 +235,7 @@ def main():
         
         # 1. Traitement et export des RECORDS (Point par point)
         df_records = parse_fit_records(ff)
-        df_records.to_csv(output_path_records_csv, index=False)
+        write_output(df_records, output_path_records, output_format, OUTPUT_FLOAT_DECIMALS, FORMATTED_TIME_COLUMNS)
         
         # 2. Traitement et export du RÉSUMÉ de l'activité (Haut niveau)
         activity_summary = extract_activity_summary(ff)
@@ -206,8 +245,9 @@ def main():
         # 3. Renvoyer les chemins des fichiers en JSON
         result = {
             "status": "success",
-            "message": "Fichiers CSV et JSON générés avec succès.",
-            "records_csv_path": str(output_path_records_csv),
+            "message": f"Fichiers {output_format.upper()} et JSON générés avec succès.",
+            "output_format": output_format,
+            f"records_{output_format}_path": str(output_path_records),
             "summary_json_path": str(output_path_summary_json)
         }
         print(json.dumps(result))
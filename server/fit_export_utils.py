@@ -0,0 +1,113 @@
+"""
+Fonctions communes aux scripts d'extraction FIT (extract_fit_file.py et extract_fit_file_for_V3.py) :
+calcul du moving time, réduction des types des records et export CSV / Parquet.
+"""
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except ImportError:
+    # PyArrow est optionnel : sans lui, les CSV sont écrits par pandas
+    pa = None
+
+# Seuil pour la détection des arrêts longs et immobiles pour le calcul du Moving Time
+PAUSE_TIME_THRESHOLD_S = 10.0
+PAUSE_DISTANCE_THRESHOLD_M = 1.0
+
+# Formats de sortie acceptés par l'option --format (csv par défaut)
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+def compute_moving_time(elapsed_time_s, distance):
+    """
+    Moving time (s) à partir des tableaux elapsed_time_s et distance, via des différences
+    numpy sur les tableaux bruts : chaque pause réelle (grand dt ET petit dd) est retranchée
+    du temps écoulé, à 1 seconde près pour compter l'arrêt.
+    """
+    elapsed_time_s = np.asarray(elapsed_time_s, dtype=np.float64)
+    distance = np.asarray(distance, dtype=np.float64)
+    
+    # Différence de temps (dt) et de distance (dd) entre les points, 0 pour le premier point
+    dt = np.zeros_like(elapsed_time_s)
+    np.subtract(elapsed_time_s[1:], elapsed_time_s[:-1], out=dt[1:])
+    dd = np.zeros_like(distance)
+    np.subtract(distance[1:], distance[:-1], out=dd[1:])
+    dd[np.isnan(dd)] = 0.0
+    
+    # Détection des pauses: grand dt ET petit dd, corrigées de dt - 1 seconde
+    is_real_pause = (dt >= PAUSE_TIME_THRESHOLD_S) & (dd <= PAUSE_DISTANCE_THRESHOLD_M)
+    pause_correction_s = np.where(is_real_pause, dt - 1.0, 0.0)
+    return elapsed_time_s - pause_correction_s.cumsum()
+
+def downcast_record_dtypes(df, record_dtypes):
+    """
+    Réduit la largeur des colonnes présentes selon record_dtypes ({colonne: type cible}).
+    Une colonne entière dont les valeurs sortent des bornes du type cible est conservée telle quelle.
+    """
+    dtypes = {}
+    for col, dtype in record_dtypes.items():
+        if col not in df.columns:
+            continue
+        target = pd.api.types.pandas_dtype(dtype)
+        if pd.api.types.is_integer_dtype(target):
+            # Le cast entier ne vérifie pas les bornes : on contrôle la plage avant de réduire
+            values = pd.to_numeric(df[col], errors='coerce')
+            limits = np.iinfo(target.numpy_dtype)
+            if values.notna().any() and (values.min() < limits.min or values.max() > limits.max):
+                continue
+        dtypes[col] = dtype
+    return df.astype(dtypes, errors='ignore')
+
+def write_csv(df, output_path):
+    """
+    Exporte le DataFrame en CSV via PyArrow (sérialisation C++ par colonnes), sinon via pandas.
+    Le format reste celui attendu par dataParser.js : en-tête et valeurs sans guillemets,
+    timestamps au format YYYY-MM-DD HH:MM:SS.
+    """
+    if pa is not None:
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            for i, field in enumerate(table.schema):
+                if pa.types.is_timestamp(field.type):
+                    timestamps = table.column(i).cast(pa.timestamp('s'))
+                    table = table.set_column(i, field.name, pc.strftime(timestamps, format='%Y-%m-%d %H:%M:%S'))
+                    
+            with open(output_path, 'wb') as f:
+                f.write((','.join(table.column_names) + '\n').encode('utf-8'))
+                pacsv.write_csv(table, f, pacsv.WriteOptions(include_header=False, quoting_style='none'))
+            return
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # Colonne non convertible ou valeur nécessitant des guillemets : repli sur pandas
+            pass
+            
+    df.to_csv(output_path, index=False)
+
+def parse_output_format(args):
+    """
+    Extrait l'option '--format csv|parquet' des arguments de la ligne de commande.
+    Renvoie (arguments positionnels restants, format), ou (args, None) si le format est invalide.
+    """
+    args = list(args)
+    output_format = 'csv'
+    if '--format' in args:
+        i = args.index('--format')
+        output_format = args[i + 1] if i + 1 < len(args) else None
+        del args[i:i + 2]
+    if output_format not in OUTPUT_FORMATS:
+        return args, None
+    return args, output_format
+
+def write_output(df, output_path, output_format, float_decimals, formatted_time_columns):
+    """
+    Exporte le DataFrame en CSV ou en Parquet (snappy) selon output_format, avec les colonnes
+    flottantes arrondies selon float_decimals dans les deux cas. Les colonnes de temps formaté
+    (formatted_time_columns) sont omises en Parquet : le frontend peut les recalculer.
+    """
+    df = df.round(float_decimals)
+    if output_format == 'parquet':
+        df = df.drop(columns=formatted_time_columns, errors='ignore')
+        df.to_parquet(output_path, compression='snappy', index=False)
+    else:
+        write_csv(df, output_path)